@@ -1,4 +1,6 @@
 import os
+import torch
+from torch.utils.data import Dataset
 import torchvision.datasets as datasets
 
 __DATASETS_DEFAULT_PATH = '/home/wch/data/cifar100'
@@ -41,4 +43,41 @@ def get_dataset(name, split='train', transform=None,
         return datasets.ImageFolder(root=root,
                                     transform=transform,
                                     target_transform=target_transform)
-    
+
+
+class CachedCIFAR(Dataset):
+    '''
+    Whole CIFAR split held in RAM as one uint8 (N, 3, H, W) tensor.
+    Batches are gathered in one index_select straight into pinned memory
+    (__getitems__, use with collate_fn=CachedCIFAR.collate) and returned
+    untransformed; crop/flip/normalize are left to the GPU batch transform
+    (see data.preprocess.get_gpu_transform).
+    '''
+    def __init__(self, dataset, input_size=None):
+        images = torch.from_numpy(dataset.data).permute(0, 3, 1, 2)
+        if input_size is not None and input_size < images.shape[-1]:
+            # same as transforms.CenterCrop(input_size)
+            top = int(round((images.shape[-2] - input_size) / 2.))
+            left = int(round((images.shape[-1] - input_size) / 2.))
+            images = images[..., top:top + input_size, left:left + input_size]
+        self.images = images.contiguous()
+        self.labels = torch.tensor(dataset.targets, dtype=torch.long)
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def __getitem__(self, index):
+        return self.images[index], self.labels[index]
+
+    def __getitems__(self, indices):
+        index = torch.as_tensor(indices, dtype=torch.long)
+        images = torch.empty((len(index),) + tuple(self.images.shape[1:]), dtype=self.images.dtype, pin_memory=True)
+        labels = torch.empty(len(index), dtype=self.labels.dtype, pin_memory=True)
+        torch.index_select(self.images, 0, index, out=images)
+        torch.index_select(self.labels, 0, index, out=labels)
+        return images, labels
+
+    @staticmethod
+    def collate(batch):
+        # __getitems__ already returns the collated (images, labels) batch
+        return batch
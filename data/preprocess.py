@@ -1,6 +1,8 @@
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as transforms
 import random
+import math
 
 __imagenet_stats = {'mean': [0.485, 0.456, 0.406],
                    'std': [0.229, 0.224, 0.225]}
@@ -76,6 +78,8 @@ def inception_color_preproccess(input_size, normalize=__imagenet_stats):
     ])
 
 
+# geometric transforms run on PIL images (before ToTensor) so that the
+# SIMD resize/crop/rotate paths of pillow-simd are used when it is installed
 def get_transform(name='imagenet', input_size=None,
                   scale_size=None, normalize=None, augment=True):
     normalize = normalize or __imagenet_stats
@@ -110,6 +114,69 @@ def get_transform(name='imagenet', input_size=None,
                               scale_size=scale_size, normalize=normalize)
 
 
+def get_gpu_transform(name='cifar100', input_size=None, scale_size=None, augment=True):
+    """Device-side variant of get_transform: the CPU transform only converts images
+    to uint8 tensors, the returned GPU transform augments/normalizes whole batches"""
+    if 'cifar' not in name:
+        raise ValueError('GPU preprocessing is only implemented for cifar datasets')
+    input_size = input_size or 32
+    cpu_transform = transforms.Compose([
+        transforms.CenterCrop(input_size),
+        transforms.PILToTensor(),
+    ])
+    if augment:
+        scale_size = scale_size or 40
+        gpu_transform = GPUAugment(padding=int((scale_size - input_size) / 2),
+                                   flip=True, degrees=15, normalize=__cifar100_stats)
+    else:
+        gpu_transform = GPUAugment(normalize=__cifar100_stats)
+    return cpu_transform, gpu_transform
+
+
+class GPUAugment(object):
+    """Batched pad_random_crop (random crop with zero padding, horizontal flip,
+    rotation) + normalize on uint8 NCHW batches already on the device"""
+
+    def __init__(self, normalize, padding=0, flip=False, degrees=0):
+        self.padding = padding
+        self.flip = flip
+        self.degrees = degrees
+        self.mean = torch.tensor(normalize['mean']).view(1, -1, 1, 1)
+        self.std = torch.tensor(normalize['std']).view(1, -1, 1, 1)
+
+    def __call__(self, img):
+        if self.mean.device != img.device:
+            self.mean = self.mean.to(img.device)
+            self.std = self.std.to(img.device)
+        img = img.float().div_(255)
+        if self.padding or self.flip or self.degrees:
+            img = self.affine(img)
+        return img.sub_(self.mean).div_(self.std)
+
+    def affine(self, img):
+        # crop, flip and rotation folded into one sampling grid (output -> input coords):
+        # in = flip^-1 @ rot^-1 @ out + shift, out-of-image samples are zero filled
+        n, _, h, w = img.shape
+        device = img.device
+        angle = torch.empty(n, device=device).uniform_(-self.degrees, self.degrees) * math.pi / 180
+        cos, sin = angle.cos(), angle.sin()
+        if self.flip:
+            sign = torch.randint(0, 2, (n,), device=device).float() * 2 - 1
+        else:
+            sign = torch.ones(n, device=device)
+        # integer pixel shifts, in normalized [-1, 1] coordinates
+        shift = torch.randint(-self.padding, self.padding + 1, (n, 2), device=device).float()
+        shift_x = shift[:, 0] * (2 / w)
+        shift_y = shift[:, 1] * (2 / h)
+
+        theta = torch.stack([
+            torch.stack([sign * cos, -sign * sin, shift_x], dim=1),
+            torch.stack([sin, cos, shift_y], dim=1),
+        ], dim=1)
+        grid = F.affine_grid(theta, list(img.shape), align_corners=False)
+        return F.grid_sample(img, grid, mode='nearest', padding_mode='zeros', align_corners=False)
+
+
 class Lighting(object):
     """Lighting noise(AlexNet - style PCA - based noise)"""
 
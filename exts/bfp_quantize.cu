@@ -0,0 +1,128 @@
+#include <torch/extension.h>
+#include <ATen/cuda/CUDAContext.h>
+#include <c10/cuda/CUDAGuard.h>
+#include <vector>
+
+/*
+Fused Block Floating Point (BFP) quantizer, the CUDA counterpart of Q_core.BFPQuant.
+One thread handles one block:
+    - shared exponent: max over the block of the fp32 exponent field of |x|
+    - grid:            delta = 2^(exponent_max + 1) / 2^(bw - 1)
+    - quantize:        clip(round(x / delta + noise), 1 - 2^(bw-1), max(2^(bw-1) - 1, 0)) * delta
+Elements of partial blocks that fall outside the tensor act as zero padding and
+are never written. Returns the quantized tensor and the per-block shared exponent
+(used on the python side for the sparsity statistics).
+Built without --use_fast_math on purpose: the division and round-half-even must
+match the python implementation bit for bit.
+*/
+
+__global__ void bfp_quantize_kernel(
+    const float* __restrict__ data,
+    const float* __restrict__ noise,
+    const float* __restrict__ block_bw,
+    float* __restrict__ output,
+    float* __restrict__ exponent_max,
+    int64_t N, int64_t C, int64_t H, int64_t W,
+    int64_t BN, int64_t BC, int64_t BH, int64_t BW,
+    int64_t s0, int64_t s1, int64_t s2, int64_t s3) {
+
+    const int64_t block = (int64_t)blockIdx.x * blockDim.x + threadIdx.x;
+    if (block >= BN * BC * BH * BW) {
+        return;
+    }
+
+    // block coordinates, last dim fastest so that neighbouring threads read neighbouring data
+    const int64_t bw_idx = block % BW;
+    const int64_t bh_idx = (block / BW) % BH;
+    const int64_t bc_idx = (block / (BW * BH)) % BC;
+    const int64_t bn_idx = block / (BW * BH * BC);
+
+    const int64_t n0 = bn_idx * s0, n1 = min(n0 + s0, N);
+    const int64_t c0 = bc_idx * s1, c1 = min(c0 + s1, C);
+    const int64_t h0 = bh_idx * s2, h1 = min(h0 + s2, H);
+    const int64_t w0 = bw_idx * s3, w1 = min(w0 + s3, W);
+
+    int e_max = -127;   // exponent field of 0.0f
+    for (int64_t n = n0; n < n1; n++)
+        for (int64_t c = c0; c < c1; c++)
+            for (int64_t h = h0; h < h1; h++)
+                for (int64_t w = w0; w < w1; w++) {
+                    const float x = data[((n * C + c) * H + h) * W + w];
+                    e_max = max(e_max, (__float_as_int(fabsf(x)) >> 23) - 127);
+                }
+    exponent_max[block] = (float)e_max;
+
+    const float bins = ldexpf(1.0f, (int)rintf(block_bw[block]) - 1);
+    const float delta = ldexpf(1.0f, e_max + 1) / bins;
+    const float min_value = 1.0f - bins;
+    const float max_value = fmaxf(bins - 1.0f, 0.0f);
+
+    for (int64_t n = n0; n < n1; n++)
+        for (int64_t c = c0; c < c1; c++)
+            for (int64_t h = h0; h < h1; h++)
+                for (int64_t w = w0; w < w1; w++) {
+                    const int64_t idx = ((n * C + c) * H + h) * W + w;
+                    float q = data[idx] / delta;
+                    if (noise != nullptr) {
+                        q += noise[idx];
+                    }
+                    q = fminf(fmaxf(rintf(q), min_value), max_value);
+                    output[idx] = q * delta;
+                }
+}
+
+std::vector<at::Tensor> bfp_quantize(
+    const at::Tensor& data,
+    const at::Tensor& block_bw,
+    std::vector<int64_t> block_size,
+    c10::optional<at::Tensor> noise) {
+
+    TORCH_CHECK(data.is_cuda(), "bfp_quantize: data must be a CUDA tensor");
+    TORCH_CHECK(data.scalar_type() == at::kFloat, "bfp_quantize: data must be float32");
+    TORCH_CHECK(data.dim() == 4 && block_bw.dim() == 4 && block_size.size() == 4,
+                "bfp_quantize: expects 4-d data, block_bw and block_size");
+    for (int i = 0; i < 4; i++) {
+        TORCH_CHECK(block_size[i] > 0, "bfp_quantize: block_size entries must be positive");
+        TORCH_CHECK(block_bw.size(i) * block_size[i] >= data.size(i),
+                    "bfp_quantize: block_bw grid does not cover data along dim ", i);
+    }
+
+    const at::cuda::OptionalCUDAGuard device_guard(device_of(data));
+
+    const at::Tensor input = data.contiguous();
+    const at::Tensor bw = block_bw.to(input.device(), at::kFloat).contiguous();
+    at::Tensor output = at::empty_like(input);
+    at::Tensor exponent_max = at::empty(bw.sizes(), bw.options());
+
+    at::Tensor noise_tensor;
+    const float* noise_ptr = nullptr;
+    if (noise.has_value() && noise->defined()) {
+        noise_tensor = noise->to(at::kFloat).contiguous();
+        TORCH_CHECK(noise_tensor.sizes() == input.sizes(), "bfp_quantize: noise must match data shape");
+        noise_ptr = noise_tensor.data_ptr<float>();
+    }
+
+    const int64_t num_blocks = bw.numel();
+    if (num_blocks == 0) {
+        return {output, exponent_max};
+    }
+    const int threads = 256;
+    const int64_t grid = (num_blocks + threads - 1) / threads;
+
+    bfp_quantize_kernel<<<grid, threads, 0, at::cuda::getCurrentCUDAStream()>>>(
+        input.data_ptr<float>(),
+        noise_ptr,
+        bw.data_ptr<float>(),
+        output.data_ptr<float>(),
+        exponent_max.data_ptr<float>(),
+        input.size(0), input.size(1), input.size(2), input.size(3),
+        bw.size(0), bw.size(1), bw.size(2), bw.size(3),
+        block_size[0], block_size[1], block_size[2], block_size[3]);
+    C10_CUDA_KERNEL_LAUNCH_CHECK();
+
+    return {output, exponent_max};
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    m.def("bfp_quantize", &bfp_quantize, "fused BFP quantization (returns quantized data, block exponent max)");
+}
@@ -19,8 +19,11 @@ cur_dir = os.path.abspath(os.path.curdir)
 
 cudnn_convolution = load(name='cudnn_convolution', sources=['./exts/cudnn_convolution.cpp'], verbose=True)
 
+# custom_fwd(cast_inputs=torch.float32): the quantizers decompose fp32 bit patterns,
+# so these functions always run in fp32, also inside an autocast region.
 class BFP_conv2d(InplaceFunction):
     @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(ctx, input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, q_params:Q_params=Q_params(), quantize_grad=True):
         ctx.input = input
         ctx.weight = weight
@@ -67,6 +70,7 @@ class BFP_conv2d(InplaceFunction):
         return output
     
     @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
     def backward(ctx, grad_output):
         q_params:Q_params = ctx.q_params
         input = ctx.input
@@ -122,6 +126,7 @@ class BFP_conv2d(InplaceFunction):
 
 class BFP_linear(InplaceFunction):
     @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(ctx, input, weight, bias=None, q_params:Q_params=Q_params(), quantize_grad=True):
         ctx.input = input
         ctx.weight = weight
@@ -172,6 +177,7 @@ class BFP_linear(InplaceFunction):
         return output
 
     @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
     def backward(ctx, grad_output):
         q_params:Q_params = ctx.q_params
         input = ctx.input
@@ -233,6 +239,7 @@ class BFP_linear(InplaceFunction):
 
 class INT_conv2d(InplaceFunction):
     @staticmethod   
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(ctx, input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1, bw=[8, 8, 8, 8]): # A,W,G,GA
         ctx.input = input
         ctx.weight = weight
@@ -248,6 +255,7 @@ class INT_conv2d(InplaceFunction):
         return output
 
     @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
     def backward(ctx, grad_output):
         stride, padding, dilation, groups = ctx.args
         bw = ctx.bw
@@ -280,6 +288,7 @@ class INT_conv2d(InplaceFunction):
 
 class INT_linear(InplaceFunction):
     @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(ctx, input, weight, bias=None, bw=[8,8,8,8,8]):
         ctx.input = input
         ctx.weight = weight
@@ -295,6 +304,7 @@ class INT_linear(InplaceFunction):
         return output
 
     @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
     def backward(ctx, grad_output):
         bw = ctx.bw
         raw_input = ctx.input
@@ -319,6 +329,7 @@ class INT_linear(InplaceFunction):
 
 class FP_conv2d(InplaceFunction):
     @staticmethod   
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(ctx, input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1): # A,W,G,GA
         ctx.input = input
         ctx.weight = weight
@@ -332,6 +343,7 @@ class FP_conv2d(InplaceFunction):
         return output
 
     @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
     def backward(ctx, grad_output):
         stride, padding, dilation, groups = ctx.args
         raw_input = ctx.input
@@ -360,6 +372,7 @@ class FP_conv2d(InplaceFunction):
 
 class FP_linear(InplaceFunction):
     @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(ctx, input, weight, bias=None):
         ctx.input = input
         ctx.weight = weight
@@ -372,6 +385,7 @@ class FP_linear(InplaceFunction):
         return output
 
     @staticmethod
+    @torch.amp.custom_bwd(device_type='cuda')
     def backward(ctx, grad_output):
 
         raw_input = ctx.input
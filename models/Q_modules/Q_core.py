@@ -4,6 +4,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np 
 import time
+import os
+from torch.utils.cpp_extension import load
 
 # from einops import rearrange, repeat, reduce
 
@@ -29,6 +31,14 @@ import time
 
 '''
 
+# fused CUDA BFP quantizer (exts/bfp_quantize.cu), BFPQuant falls back to torch ops without it
+if torch.cuda.is_available():
+    BFP_cuda = load(name='bfp_quantize',
+                    sources=[os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../exts/bfp_quantize.cu')],
+                    extra_cuda_cflags=['-O3'], verbose=True)
+else:
+    BFP_cuda = None
+
 ### BFP Basis
 
 def BFP_padding(data, padding_shape):  # 如果形状不符合，对
@@ -38,11 +48,15 @@ def BFP_padding(data, padding_shape):  # 如果形状不符合，对
         data = torch.cat([data, torch.zeros(data.shape[0], padding_size[1], data.shape[2], data.shape[3], device=device)], dim=1)
     if padding_size[0]:
         data = torch.cat([data, torch.zeros(padding_size[0], data.shape[1], data.shape[2], data.shape[3], device=device)], dim=0)
+    if padding_size[3]:
+        data = torch.cat([data, torch.zeros(data.shape[0], data.shape[1], data.shape[2], padding_size[3], device=device)], dim=3)
+    if padding_size[2]:
+        data = torch.cat([data, torch.zeros(data.shape[0], data.shape[1], padding_size[2], data.shape[3], device=device)], dim=2)
     return data
 
 def get_BFP_shape(data_shape, block_size):
     # print('get_BFP_shape:', data_shape, block_size)
-    return list(np.ceil(np.array(data_shape) / block_size).astype(np.int))
+    return list(np.ceil(np.array(data_shape) / block_size).astype(int))
 
 def get_BFP_paddingshape(data_shape, block_size):
     BFPshape = get_BFP_shape(data_shape, block_size)
@@ -106,6 +120,25 @@ def BFPQuant(data:torch.tensor, block_size:tuple, block_bw:tuple, stochastic=Fal
     if block_size is None or block_bw is None:  # block_size或block_bw为None时，不进行量化
         return data 
     
+    with torch.no_grad():
+        BFPshape = list(block_bw.shape)
+        if BFP_cuda is not None and data.is_cuda and data.dtype == torch.float32:
+            noise = data.new(data.shape).uniform_(-0.5, 0.5) if stochastic else None
+            data_quantized, exponent_max = BFP_cuda.bfp_quantize(data, block_bw, list(block_size), noise)
+        else:
+            data_quantized, exponent_max = BFPQuant_torch(data, block_size, block_bw, stochastic)
+
+        if sparsity_counter is not None: 
+            non_zeros = (exponent_max > -31) & (block_bw != 0)
+            # if data.shape[0] == 128:
+            #     print(torch.count_nonzero(block_bw == 0))
+            #     print(block_bw[:4, :4, 0,0].cpu().numpy())
+            sparsity = 1 - torch.count_nonzero(non_zeros) / np.product(BFPshape)
+            sparsity_counter.update(sparsity.cpu())
+        return data_quantized
+
+def BFPQuant_torch(data, block_size, block_bw, stochastic=False):
+    # reference implementation of BFPQuant, returns (data_quantized, exponent_max)
     with torch.no_grad():
         BFPshape = list(block_bw.shape)
         data_shape = data.shape
@@ -116,15 +149,10 @@ def BFPQuant(data:torch.tensor, block_size:tuple, block_bw:tuple, stochastic=Fal
         # _, exponent, _ = decompose_tensor(data_padding)
         exponent_max = exponent_block.reshape(BFPshape[0], BFPshape[1], BFPshape[2], BFPshape[3], -1).max(axis=4).values # get max exponent
         # exponent_max = BFP_max(exponent, block_size)
-        if sparsity_counter is not None: 
-            non_zeros = (exponent_max > -31) & (block_bw != 0)
-            # if data.shape[0] == 128:
-            #     print(torch.count_nonzero(block_bw == 0))
-            #     print(block_bw[:4, :4, 0,0].cpu().numpy())
-            sparsity = 1 - torch.count_nonzero(non_zeros) / np.product(BFPshape)
-            sparsity_counter.update(sparsity.cpu())
 
         bins = (torch.tensor(1) << (block_bw-1))
+        # bw 0 prunes the block: keep delta finite so it rounds to 0 (int maps give 1 << -1 == 0 -> 0 * inf)
+        bins = torch.where(block_bw > 0, bins, 0.5)
         delta_block = (torch.tensor(1) << (exponent_max + 1)) / bins
         
         delta_block = torch.tile(delta_block[:, :, :, :, None, None, None, None], block_size)
@@ -134,7 +162,7 @@ def BFPQuant(data:torch.tensor, block_size:tuple, block_bw:tuple, stochastic=Fal
 
         data_quantized = BFP_deblock(data_block, data_padding_shape)                                  # data deblock
         data_quantized = data_quantized[:data_shape[0], :data_shape[1], :data_shape[2], :data_shape[3]] # clip shape
-        return data_quantized
+        return data_quantized, exponent_max
 
 def INTQuant(data:torch.Tensor, bw, stochastic=False, mode='absmax'):
     if mode == 'exp':
@@ -0,0 +1,50 @@
+import torch
+from Q_core import *
+
+# Deterministic comparison of the fused CUDA quantizer (exts/bfp_quantize.cu)
+# against the torch reference BFPQuant_torch. Run from models/Q_modules on a CUDA machine.
+
+def check(data, block_size, block_bw):
+    q_ref, e_ref = BFPQuant_torch(data, block_size, block_bw, stochastic=False)
+    q_cuda, e_cuda = BFP_cuda.bfp_quantize(data, block_bw, list(block_size), None)
+    assert torch.equal(q_cuda, q_ref.contiguous()), 'quantized data differs'
+    assert torch.equal(e_cuda, e_ref.float()), 'exponent_max differs'
+
+def make_case(shape, block_size, bw_dtype):
+    torch.manual_seed(0)
+    data = torch.randn(shape, device='cuda') * 3
+    data[:block_size[0], :block_size[1]] = 0                    # all-zero blocks
+    BFPshape = get_BFP_shape(data.shape, block_size)
+    block_bw = torch.randint(0, 9, BFPshape, device='cuda')     # includes bitwidth 0
+    if bw_dtype == 'int':
+        block_bw = block_bw.int()
+    else:
+        block_bw = block_bw.float()
+    return data, block_bw
+
+def test_bfp_quantize_cuda():
+    for shape, block_size in [
+        ([8, 16, 3, 3], [4, 4, 1, 1]),      # evenly divided
+        ([6, 10, 5, 3], [4, 4, 1, 1]),      # partial blocks along N/C
+        ([5, 7, 5, 3], [4, 4, 2, 2]),       # partial blocks along every dim
+    ]:
+        for bw_dtype in ['int', 'float']:
+            data, block_bw = make_case(shape, block_size, bw_dtype)
+            check(data, block_size, block_bw)
+
+def test_bfp_quantize_cuda_uncovered():
+    data = torch.randn([8, 8, 1, 1], device='cuda')
+    block_bw = torch.ones([1, 2, 1, 1], device='cuda') * 4   # covers only 4 of 8 rows
+    try:
+        BFP_cuda.bfp_quantize(data, block_bw, [4, 4, 1, 1], None)
+    except RuntimeError:
+        return
+    raise AssertionError('uncovered data was not rejected')
+
+if __name__ == '__main__':
+    if BFP_cuda is None:
+        print('CUDA not available, skipped')
+    else:
+        test_bfp_quantize_cuda()
+        test_bfp_quantize_cuda_uncovered()
+        print('BFP CUDA quantizer matches BFPQuant_torch')
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 import numpy as np
 import time
 
@@ -48,6 +49,17 @@ class Q_Optimizer():
             q_params.sensitivity['W'] = torch.zeros_like(q_params.sensitivity['W'])
             q_params.sensitivity['bA'] = torch.zeros_like(q_params.sensitivity['bA'])
 
+    def sync_sensitivity(self):
+        # sensitivity is accumulated from each rank's own grads; average it so every
+        # DDP replica derives the same bwmaps (no-op outside of distributed runs)
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        world_size = dist.get_world_size()
+        for q_params in self.q_params_list:
+            for datatype in ['W', 'bA']:
+                dist.all_reduce(q_params.sensitivity[datatype])
+                q_params.sensitivity[datatype] /= world_size
+
     def tuning_sensitivity(self, batches):
         print('batches=', batches)
         for q_params in self.q_params_list:
@@ -1,11 +1,12 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, DistributedSampler
 import numpy as np
 
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
 
 from datetime import datetime
 
@@ -15,8 +16,8 @@ import sys
 import wandb
 import time
 import json
-from data.dataset import get_dataset
-from data.preprocess import get_transform
+from data.dataset import get_dataset, CachedCIFAR
+from data.preprocess import get_transform, get_gpu_transform
 # from models.resnet_BFP import resnet_BFP
 from models import resnet, resnet_BFP
 
@@ -27,19 +28,26 @@ parser = argparse.ArgumentParser()
 
 ### global arguments
 parser.add_argument('--seed', type=int, default=123, help='random seed')
+parser.add_argument('--deterministic', action='store_true', help='disable cuDNN autotuning and TF32 for reproducible runs')
 parser.add_argument('--trainer_config', type=str, default=None)
 parser.add_argument('--wandb_project', type=str, default=None)
 parser.add_argument('--local_rank', type=int, default=0)
 parser.add_argument('--ddp')
+parser.add_argument('--ddp_comm_hook', default='none', choices=['none', 'fp16', 'bf16', 'powerSGD'],
+                    help='compress gradients before the DDP allreduce')
 
 ### logging arguments
 parser.add_argument('--results_dir', default='./results', help='results dir')
 parser.add_argument('--save', default='', help='saved folder')
 parser.add_argument('--log_freq', type=int, default=10)
+parser.add_argument('--profile', action='store_true', help='measure batch/data time on log ticks (syncs once per tick)')
 
 ### dataset arguments
 parser.add_argument('--dataset', type=str, default='cifar100')
 parser.add_argument('--datapath', type=str, default='/home/wch/data/cifar100')
+parser.add_argument('--gpu_augment', action='store_true', help='run augmentation/normalization on the GPU (cifar only)')
+parser.add_argument('--cache_dataset', action='store_true',
+                    help='keep the whole split in RAM and gather batches in-process (cifar only, needs --gpu_augment)')
 
 ### model arguments
 parser.add_argument('--model', default='resnet_BFP', choices=['resnet', 'resnet_BFP'])
@@ -48,6 +56,13 @@ parser.add_argument('--model_config', default='')
 parser.add_argument('--q_type', default=None)
 parser.add_argument('--device', default='cuda:0')
 parser.add_argument('--workers', type=int, default=8)
+parser.add_argument('--channels_last', action='store_true', help='use NHWC memory format for model and inputs')
+parser.add_argument('--compile', action='store_true', help='torch.compile the model (slow start, faster steps)')
+parser.add_argument('--cuda_graphs', action='store_true',
+                    help='replay the training forward/backward from a CUDA graph (non-BFP models, no --ddp/--compile)')
+parser.add_argument('--pinned_pool', action='store_true',
+                    help='stage batches in reusable pinned buffers instead of the DataLoader pin-memory thread')
+parser.add_argument('--prefetch_factor', type=int, default=4, help='batches prefetched per dataloader worker')
 
 ### trainer arguments
 parser.add_argument('--epochs', type=int, default=200)
@@ -55,6 +70,8 @@ parser.add_argument('--batch_size', type=int, default=128)
 parser.add_argument('--optimizer', default='SGD')
 parser.add_argument('--warm_up_epoch', type=int, default=1)
 parser.add_argument('--lr', type=float, default=0.1, help='init lr')
+parser.add_argument('--amp_dtype', default='none', choices=['none', 'bf16', 'fp16'],
+                    help='autocast dtype for mixed precision training (BFP layers always run in fp32)')
 
 ### BFPQ argument
 parser.add_argument('--target_bit_W', type=int, default=2)
@@ -62,26 +79,48 @@ parser.add_argument('--target_bit_bA', type=int, default=2)
 parser.add_argument('--K_update_mode', type=str, default='BinarySearch')
 
 def main(args):
-    is_main_process = args.local_rank == 0
+    # torchrun passes the ranks through the environment instead of --local_rank;
+    # LOCAL_RANK picks the device, the global RANK decides who logs and writes files
+    args.local_rank = int(os.getenv('LOCAL_RANK', args.local_rank))
+    args.rank = int(os.getenv('RANK', 0))
+    is_main_process = args.rank == 0
     output_target = sys.stdout if is_main_process else open(os.devnull, 'w')
     print('Global Setting...', file=output_target)
-    args.ddp = int(os.getenv('WORLD_SIZE'), 0)>1
+    args.ddp = int(os.getenv('WORLD_SIZE', 1))>1
 
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
     np.random.seed(args.seed)
+
+    # fixed input shape (drop_last) -> let cuDNN autotune conv algorithms; TF32 on Ampere+
+    torch.backends.cudnn.benchmark = not args.deterministic
+    torch.backends.cudnn.deterministic = args.deterministic
+    torch.backends.cuda.matmul.allow_tf32 = not args.deterministic
+    torch.backends.cudnn.allow_tf32 = not args.deterministic
     day_stamp = datetime.now().strftime('%Y-%m-%d')
     time_stamp = datetime.now().strftime('%H:%M:%S')
 
     if args.ddp:
         print('Start Distributed Dataparallel Processing...', file=output_target)
-        args.device = torch.cuda.device(args.local_rank)
+        args.device = 'cuda:{}'.format(args.local_rank)
         torch.cuda.set_device(args.local_rank)
         dist.init_process_group(backend='nccl', init_method='env://')
         args.gpus = dist.get_world_size()
 
         print('Work on {} GPUs'.format(args.gpus), file=output_target)
 
+    if args.cache_dataset and not args.gpu_augment:
+        raise ValueError('--cache_dataset stores raw uint8 images and needs --gpu_augment')
+    if args.cache_dataset:
+        # nothing left for worker processes to do
+        args.workers = 0
+
+    if args.ddp_comm_hook != 'none' and not args.ddp:
+        raise ValueError('--ddp_comm_hook needs a distributed run (WORLD_SIZE > 1)')
+
+    if args.cuda_graphs and (args.ddp or args.compile):
+        raise ValueError('--cuda_graphs cannot be combined with DDP or --compile')
+
     if args.save == '':
         save_folder = args.model + '_' + time_stamp
     else:
@@ -92,13 +131,13 @@ def main(args):
     if not os.path.exists(save_path) and is_main_process:
         os.makedirs(save_path, exist_ok=True)
 
+    wandb_log = args.wandb_project is not None and is_main_process
     if is_main_process:
         print('Save at ', save_path, file=output_target)
 
         with open(save_path + '/args.json', 'w') as f:
             json.dump(args.__dict__, f, indent=4)
 
-        wandb_log = args.wandb_project is not None
         if wandb_log:
             if args.trainer_config is not None:
                 wandb_config = {'config_save':save_path}
@@ -109,10 +148,17 @@ def main(args):
             wandb.init(project=args.wandb_project, name=save_folder, config=wandb_config)
 
     print('-------- Data Loading ---------', file=output_target)
-    train_transform = get_transform(args.dataset, 
-                                    input_size=args.input_size, augment=True)
-    test_transform = get_transform(args.dataset, 
-                                   input_size=args.input_size, augment=False)
+    if args.gpu_augment:
+        train_transform, train_batch_transform = get_gpu_transform(args.dataset,
+                                                                    input_size=args.input_size, augment=True)
+        test_transform, test_batch_transform = get_gpu_transform(args.dataset,
+                                                                 input_size=args.input_size, augment=False)
+    else:
+        train_transform = get_transform(args.dataset, 
+                                        input_size=args.input_size, augment=True)
+        test_transform = get_transform(args.dataset, 
+                                       input_size=args.input_size, augment=False)
+        train_batch_transform, test_batch_transform = None, None
     
     train_set = get_dataset(args.dataset, split='train', 
                             transform=train_transform, 
@@ -121,18 +167,38 @@ def main(args):
                            transform=test_transform, 
                            datasets_path=args.datapath)
     
+    if args.cache_dataset:
+        train_set = CachedCIFAR(train_set, input_size=args.input_size)
+        test_set = CachedCIFAR(test_set, input_size=args.input_size)
+
+    # keep the worker pool alive across epochs (only valid with worker processes)
+    if args.workers > 0:
+        loader_kwargs = {'persistent_workers': True, 'prefetch_factor': args.prefetch_factor}
+    else:
+        loader_kwargs = {}
+    if args.cache_dataset:
+        loader_kwargs['collate_fn'] = CachedCIFAR.collate
+
+    if args.ddp:
+        train_sampler = DistributedSampler(train_set, shuffle=True, seed=args.seed)
+    else:
+        train_sampler = None
+
     train_loader = DataLoader(train_set, 
-                              batch_size=args.batch_size, shuffle=True, drop_last=True,
-                              num_workers=args.workers, pin_memory=True)
+                              batch_size=args.batch_size, shuffle=(train_sampler is None), drop_last=True,
+                              sampler=train_sampler,
+                              num_workers=args.workers, pin_memory=not args.pinned_pool, **loader_kwargs)
     
     test_loader = DataLoader(test_set,
                              batch_size=args.batch_size, shuffle=False,
-                             num_workers=args.workers, pin_memory=True)
+                             num_workers=args.workers, pin_memory=not args.pinned_pool, **loader_kwargs)
     
     print('--------- Model Creating ---------',file=output_target)
 
     # model = resnet_BFP(depth=18, dataset='cifar100').to(args.device)
     model = resnet(depth=18, dataset='cifar100').to(args.device)
+    memory_format = torch.channels_last if args.channels_last else torch.preserve_format
+    model = model.to(memory_format=memory_format)
     criterion = nn.CrossEntropyLoss().to(args.device)
     optimizer = get_optimizer(args.optimizer, model.parameters())
     scheme = Scheme(init_lr=args.lr, warm_up_epoch=args.warm_up_epoch)
@@ -161,15 +227,42 @@ def main(args):
                     criterion=criterion,
                     train_loader=train_loader, test_loader=test_loader,
                     device=args.device, log_freq=args.log_freq,
-                    wandb_logger=wandb_logger)
+                    wandb_logger=wandb_logger, output_target=output_target,
+                    amp_dtype=args.amp_dtype, memory_format=memory_format,
+                    train_batch_transform=train_batch_transform, test_batch_transform=test_batch_transform,
+                    pinned_pool=args.pinned_pool, profile=args.profile)
 
     if args.trainer_config is not None:
         trainer.load_config(args.trainer_config)
 
-    dummy_input = torch.zeros([args.batch_size, 3, args.input_size, args.input_size], device=args.device)
+    # only the shape matters: the register pass records per-layer BFP shapes (incl. batch dim)
+    dummy_input = torch.empty([args.batch_size, 3, args.input_size, args.input_size], device=args.device)
     trainer.register(dummy_input=dummy_input)
 
-    trainer.save_config(save_dir=save_path)
+    if args.cuda_graphs:
+        # batch shape is static: train_loader uses drop_last, eval runs eagerly
+        trainer.capture_cuda_graph(dummy_input)
+
+    if args.ddp:
+        # wrap after register(), which needs the bare model for the BFP reg-pass
+        trainer.model = DDP(model, device_ids=[args.local_rank],
+                            bucket_cap_mb=25, gradient_as_bucket_view=True)
+        if args.ddp_comm_hook == 'fp16':
+            trainer.model.register_comm_hook(None, default_hooks.fp16_compress_hook)
+        elif args.ddp_comm_hook == 'bf16':
+            trainer.model.register_comm_hook(None, default_hooks.bf16_compress_hook)
+        elif args.ddp_comm_hook == 'powerSGD':
+            # plain allreduce for the first iterations, then rank-1 low-rank approximation
+            powerSGD_state = powerSGD_hook.PowerSGDState(process_group=None, matrix_approximation_rank=1,
+                                                         start_powerSGD_iter=100)
+            trainer.model.register_comm_hook(powerSGD_state, powerSGD_hook.powerSGD_hook)
+
+    if args.compile:
+        # fullgraph=False: the BFP quantizers break the graph on python-side bookkeeping
+        trainer.model = torch.compile(trainer.model, mode='max-autotune', fullgraph=False)
+
+    if is_main_process:
+        trainer.save_config(save_dir=save_path)
 
     print('-------- Training --------',file=output_target)
     best_prec = 0
@@ -181,12 +274,16 @@ def main(args):
         trainer.test(epoch)
         trainer.train_logger.log('END TEST')
         best_prec = max(best_prec, trainer.train_logger.top1.avg)
-        if epoch % 5 == 0:
+        if epoch % 5 == 0 and is_main_process:
             model_dir = save_path + '/epoch_' + str(epoch)
             trainer.save_model(model_dir)
 
+    trainer.wait_save()
     print('--------- Training Done ---------',file=output_target)
-    print(best_prec)
+    print(best_prec, file=output_target)
+
+    if args.ddp:
+        dist.destroy_process_group()
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -3,4 +3,9 @@
 CUDA_VISIBLE_DEVICES=[1] python train.py \
 --dataset=cifar100 --model=resnet_BFP  --q_type=BFP \
 --trainer_config=./trainer_config.json \
---device=cuda:0
\ No newline at end of file
+--device=cuda:0
+
+# multi-GPU (DistributedDataParallel):
+# CUDA_VISIBLE_DEVICES=0,1,2,3 torchrun --nproc_per_node=4 train.py \
+# --dataset=cifar100 --model=resnet_BFP  --q_type=BFP \
+# --trainer_config=./trainer_config.json
@@ -26,6 +26,7 @@ class Q_Scheduler:
         # optimizer update
         if self.q_scheme.q_type == 'BFP':
             if self.cur_epoch % self.q_scheme.update_period == 0:
+                self.q_optimizer.sync_sensitivity()
                 self.q_optimizer.tuning_sensitivity(self.batches_per_epoch*self.q_scheme.update_period)
                 self.q_optimizer.update()
         
@@ -24,8 +24,9 @@ class Scheduler:
         self.train_stage = 0
 
 
-    def zero_grad(self):
-        self.optimizer.zero_grad()
+    def zero_grad(self, set_to_none=True):
+        # set_to_none drops the grads instead of memset-ing them; backward re-allocates
+        self.optimizer.zero_grad(set_to_none=set_to_none)
 
     def update_epoch(self, epoch=None):
         if epoch is None:
@@ -33,11 +34,16 @@ class Scheduler:
         else:
             self.cur_epoch = epoch
 
-    def step(self):
+    def step(self, scaler=None):
         # step and update lr
         self.cur_batch += 1
         self.update_lr()
-        self.optimizer.step()
+        if scaler is None:
+            self.optimizer.step()
+        else:
+            # GradScaler unscales grads and skips the step on inf/nan
+            scaler.step(self.optimizer)
+            scaler.update()
 
     def update_lr(self):
         if self.cur_epoch < self.scheme.warm_up_epoch:
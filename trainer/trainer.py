@@ -1,7 +1,9 @@
 import torch
 import numpy as np
 import torch.optim as optim
+from torch.utils.data import DistributedSampler
 from utils import meters
+from utils.prefetcher import data_prefetcher, pinned_buffer_pool
 from .scheduler import Scheduler
 from .Q_scheduler import Q_Scheduler
 from .logger import BasicLogger, WandbLogger
@@ -10,12 +12,27 @@ import time
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+AMP_DTYPES = {
+    'none': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
 
 def get_optimizer(optimizer_name, params):
-    if optimizer_name == 'SGD':
-        return optim.SGD(params=params, lr=0.1, momentum=0.9, weight_decay=5e-4)
-    elif optimizer_name == 'Adam':
-        return optim.Adam(params=params)
+    params = list(params)
+    # fused multi-tensor kernels; older torch versions (or unsupported params) fall back to foreach
+    try:
+        if optimizer_name == 'SGD':
+            return optim.SGD(params=params, lr=0.1, momentum=0.9, weight_decay=5e-4, fused=True)
+        elif optimizer_name == 'Adam':
+            return optim.Adam(params=params, fused=True)
+    except (TypeError, RuntimeError):
+        if optimizer_name == 'SGD':
+            return optim.SGD(params=params, lr=0.1, momentum=0.9, weight_decay=5e-4, foreach=True)
+        elif optimizer_name == 'Adam':
+            return optim.Adam(params=params, foreach=True)
     
 class Trainer:
     '''
@@ -24,7 +41,10 @@ class Trainer:
     def __init__(self, model, scheduler:Scheduler, q_scheduler:Q_Scheduler, criterion, 
                  train_loader, test_loader, device='cuda:0', 
                  train_logger:BasicLogger=BasicLogger(), log_freq=10,
-                 wandb_logger:WandbLogger=WandbLogger(), output_target=sys.stdout):
+                 wandb_logger:WandbLogger=WandbLogger(), output_target=sys.stdout,
+                 amp_dtype='none', memory_format=torch.preserve_format,
+                 train_batch_transform=None, test_batch_transform=None, pinned_pool=False,
+                 profile=False):
         ### 
         self.model = model
         self.scheduler = scheduler  
@@ -35,11 +55,30 @@ class Trainer:
         self.device = device
         self.train_logger = train_logger
         self.log_freq = log_freq
+        self.profile = profile
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.save_future = None
         self.wandb_logger = wandb_logger
         self.output_target = output_target
 
+        # mixed precision: bf16 needs no loss scaling, fp16 does
+        self.amp_dtype = AMP_DTYPES[amp_dtype]
+        self.scaler = torch.amp.GradScaler('cuda', enabled=self.amp_dtype == torch.float16)
+        self.memory_format = memory_format
+        # device-side preprocessing applied to whole batches after the H2D copy
+        self.train_batch_transform = train_batch_transform
+        self.test_batch_transform = test_batch_transform
+        # stage batches in reusable pinned buffers instead of the DataLoader pin-memory thread
+        self.pin_pool = pinned_buffer_pool() if pinned_pool else None
+
         ### 
 
+    @property
+    def raw_model(self):
+        # bare model behind torch.compile / DistributedDataParallel wrappers (if any)
+        model = getattr(self.model, '_orig_mod', self.model)
+        return getattr(model, 'module', model)
+
     def register(self, dummy_input):
         self.train_logger.output_target = self.output_target
         if self.wandb_logger is not None:
@@ -50,12 +89,26 @@ class Trainer:
             self.q_scheduler.q_optimizer = None
             return
         
-        self.model.register()
+        self.raw_model.register()
         self.model(dummy_input)
         self.q_scheduler.register()
 
         print('Register Done.', file=self.output_target)
 
+    def capture_cuda_graph(self, sample_input):
+        # graph forward+backward of the model; the optimizer step stays eager so lr updates apply
+        if self.q_scheduler.q_scheme.q_type == 'BFP':
+            raise ValueError('CUDA graphs are not supported with BFP quantization: '
+                             'the quantizers copy sparsity statistics back to the host every step')
+        # warm-up/capture iterations must not leak into the BN running stats
+        state_dict = {k: v.clone() for k, v in self.raw_model.state_dict().items()}
+        self.raw_model.train()
+        with torch.autocast(device_type='cuda', dtype=self.amp_dtype, enabled=self.amp_dtype is not None, cache_enabled=False):
+            torch.cuda.make_graphed_callables(self.raw_model, (sample_input.to(memory_format=self.memory_format),))
+        self.raw_model.load_state_dict(state_dict)
+
+        print('CUDA Graph Captured.', file=self.output_target)
+
     def train(self, epoch):
         self.forward(epoch=epoch, dataloader=self.train_loader, train=True)
 
@@ -65,42 +118,67 @@ class Trainer:
     def forward(self, epoch, dataloader, train=True):
         
         if train:
-            self.model.train()
+            self.raw_model.train()
             self.q_scheduler.zero_sensitivity()
+            if isinstance(dataloader.sampler, DistributedSampler):
+                dataloader.sampler.set_epoch(epoch)
         else:
-            self.model.eval()
+            self.raw_model.eval()
 
         self.train_logger.reset()
+        batch_transform = self.train_batch_transform if train else self.test_batch_transform
+
+        # running sums stay on the device and are only read back on log ticks
+        loss_sum = torch.zeros(1, device=self.device)
+        prec_sum = torch.zeros(2, device=self.device)
+        window = 0
         
         time_stamp = time.time()
-        for batch, (inputs, labels) in enumerate(dataloader):
-            
-            self.train_logger.data_time.update(time.time()-time_stamp)
-            time_stamp = time.time()
+        # H2D copy of batch N+1 runs on a side stream while batch N computes
+        for batch, (inputs, labels) in enumerate(data_prefetcher(dataloader, self.device, self.memory_format, self.pin_pool)):
 
-            self.scheduler.zero_grad()
-            inputs = inputs.to(self.device)
-            labels = labels.to(self.device)
-            outputs = self.model(inputs)
+            # timing only on profiled log ticks: CUDA events measure device time without a per-batch sync
+            timed = self.profile and batch % self.log_freq == 0
+            if timed:
+                self.train_logger.data_time.update(time.time()-time_stamp)
+                start_event = torch.cuda.Event(enable_timing=True)
+                end_event = torch.cuda.Event(enable_timing=True)
+                start_event.record()
 
-            loss = self.criterion(outputs, labels)
+            if batch_transform is not None:
+                inputs = batch_transform(inputs).contiguous(memory_format=self.memory_format)
+
+            self.scheduler.zero_grad()
+            with torch.autocast(device_type='cuda', dtype=self.amp_dtype, enabled=self.amp_dtype is not None):
+                outputs = self.model(inputs)
+                loss = self.criterion(outputs, labels)
             
             if train:
-                loss.backward()
-                self.scheduler.step()
+                self.scaler.scale(loss).backward()
+                self.scheduler.step(scaler=self.scaler)
 
             prec = meters.accuracy(outputs.detach(), labels, (1, 5))
             
-            self.train_logger.batch_time.update(time.time()-time_stamp)
-            time_stamp = time.time()
+            if timed:
+                end_event.record()
+                end_event.synchronize()
+                self.train_logger.batch_time.update(start_event.elapsed_time(end_event) / 1000)
 
-            self.train_logger.losses.update(loss.detach().cpu())
-            self.train_logger.top1.update(prec[0])
-            self.train_logger.top5.update(prec[1])
+            loss_sum += loss.detach()
+            prec_sum += prec
+            window += 1
             
             if batch % self.log_freq == 0:
+                self.update_meters(loss_sum, prec_sum, window)
+                window = 0
                 self.train_logger.log(batch)
 
+            if self.profile:
+                time_stamp = time.time()
+
+        if window:
+            self.update_meters(loss_sum, prec_sum, window)
+
         if self.wandb_logger is not None:
             self.wandb_logger.update(epoch=epoch, train=train)
             self.wandb_logger.log()
@@ -113,6 +191,15 @@ class Trainer:
 
         print('Epoch: {}, lr: {}'.format(epoch, self.scheduler.lr), file=self.output_target)
 
+    def update_meters(self, loss_sum, prec_sum, count):
+        # single device->host copy for the whole window, then reset the sums
+        loss, top1, top5 = (torch.cat([loss_sum, prec_sum]) / count).tolist()
+        self.train_logger.losses.update(loss, n=count)
+        self.train_logger.top1.update(top1, n=count)
+        self.train_logger.top5.update(top5, n=count)
+        loss_sum.zero_()
+        prec_sum.zero_()
+
     def save_config(self, save_dir):
         os.makedirs(save_dir, exist_ok=True)
         trainer_config_path = save_dir + '/trainer_config.json'
@@ -138,17 +225,35 @@ class Trainer:
         trainer_state = trainer_state_path
 
     def save_model(self, model_dir):
+        # snapshot the weights here, serialize them on the background save thread
         os.makedirs(model_dir, exist_ok=True)
-        model_dict_path = model_dir + '/model.pth'
-        torch.save(self.model.state_dict(), model_dict_path)
+        state_dict = {k: v.detach().to('cpu', non_blocking=True) for k, v in self.raw_model.state_dict().items()}
+        q_params_dict = None
         if self.q_scheduler.q_scheme.q_type == 'BFP':
-            q_params_dict_path = model_dir + '/q_params.npy'
-            np.save(q_params_dict_path, self.model.q_params_dict())
+            q_params_dict = {k: v.clone() if isinstance(v, torch.Tensor) else v
+                             for k, v in self.raw_model.q_params_dict().items()}
+        copy_done = torch.cuda.Event()
+        copy_done.record()
+        # surface errors of the previous checkpoint write before queueing the next one
+        self.wait_save()
+        self.save_future = self.save_executor.submit(self._write_model, model_dir, state_dict, q_params_dict, copy_done)
+
+    def _write_model(self, model_dir, state_dict, q_params_dict, copy_done):
+        copy_done.synchronize()
+        torch.save(state_dict, model_dir + '/model.pth')
+        if q_params_dict is not None:
+            np.save(model_dir + '/q_params.npy', q_params_dict)
         print('Successful Saving Model to ' + model_dir + ' ...', file=self.output_target)
 
+    def wait_save(self):
+        # block until the pending checkpoint is on disk (re-raises save errors)
+        if self.save_future is not None:
+            self.save_future.result()
+            self.save_future = None
+
     def load_model(self, model_dir):
         model_dict_path = model_dir + '/model.pth'
-        self.model.load_state_dict(torch.load(model_dict_path))
+        self.raw_model.load_state_dict(torch.load(model_dict_path))
         if self.q_scheduler.q_scheme.q_type == 'BFP':
             q_params_dict_path = model_dir + '/q_params.npz'
-            self.model.load_q_params_dict(np.load(q_params_dict_path))
+            self.raw_model.load_q_params_dict(np.load(q_params_dict_path))
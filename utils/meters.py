@@ -56,18 +56,18 @@ class OnlineMeter(object):
 
 
 def accuracy(output, target, topk=(1,)):
-    """Computes the precision@k for the specified values of k"""
+    """Computes the precision@k for the specified values of k,
+    returned as a single tensor of shape (len(topk),) on the input device"""
     maxk = max(topk)
     batch_size = target.size(0)
     _, pred = output.topk(maxk, 1, True, True)
     pred = pred.t().type_as(target)
     correct = pred.eq(target.view(1, -1).expand_as(pred))
     # print(correct)
-    res = []
-    for k in topk:
-        correct_k = correct[:k].reshape(-1).float().sum(0)
-        res.append(correct_k.mul_(100.0 / batch_size))
-    return res
+    # hits within the top-k ranks for every k at once
+    correct_k = correct.float().sum(1).cumsum(0)
+    # stack of scalar views: a python-list index would be a blocking H2D copy
+    return torch.stack([correct_k[k - 1] for k in topk]).mul_(100.0 / batch_size)
 
 
 class AccuracyMeter(object):
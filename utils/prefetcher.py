@@ -1,19 +1,70 @@
 import torch
+from concurrent.futures import ThreadPoolExecutor
+
+class pinned_buffer_pool():
+    '''
+    Ring of reusable page-locked host buffers that batches are staged in before the
+    H2D copy. Replaces the DataLoader pin-memory thread (use with pin_memory=False):
+    fetching and staging run one batch ahead on a background thread.
+    '''
+    def __init__(self, size=2):
+        self.size = size
+        self.buffers = [None] * size
+        self.events = [None] * size
+        self.cur = 0
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, loader):
+        # future of the next batch of loader staged in a pinned slot (None once exhausted)
+        return self.executor.submit(self._fetch, loader)
+
+    def _fetch(self, loader):
+        try:
+            batch = next(loader)
+        except StopIteration:
+            return None
+        return self.pin(batch)
+
+    def pin(self, tensors):
+        idx = self.cur
+        if self.events[idx] is not None:
+            # the H2D copy out of this slot must be finished before it is overwritten
+            self.events[idx].synchronize()
+        buffers = self.buffers[idx]
+        if buffers is None or any(b.dtype != t.dtype or b.shape[1:] != t.shape[1:] or b.shape[0] < t.shape[0]
+                                  for b, t in zip(buffers, tensors)):
+            buffers = [torch.empty(t.shape, dtype=t.dtype, pin_memory=True) for t in tensors]
+            self.buffers[idx] = buffers
+        return [b[:t.shape[0]].copy_(t) for b, t in zip(buffers, tensors)]
+
+    def record(self, stream):
+        # the slot handed out by the last pin() stays busy until stream reaches this point
+        event = torch.cuda.Event()
+        event.record(stream)
+        self.events[self.cur] = event
+        self.cur = (self.cur + 1) % self.size
 
 class data_prefetcher():
-    def __init__(self, loader, device):
+    def __init__(self, loader, device, memory_format=torch.preserve_format, pin_pool:pinned_buffer_pool=None):
         self.loader = iter(loader)
         self.device = device
+        self.memory_format = memory_format
+        self.pin_pool = pin_pool
         self.stream = torch.cuda.Stream(device=device)
+        if self.pin_pool is not None:
+            self.next_pinned = self.pin_pool.submit(self.loader)
         self.preload()
 
     def preload(self):
-        try:
-            self.next_input, self.next_target = next(self.loader)
-        except StopIteration:
+        if self.pin_pool is not None:
+            batch = self.next_pinned.result()
+        else:
+            batch = next(self.loader, None)
+        if batch is None:
             self.next_input = None
             self.next_target = None
             return
+        self.next_input, self.next_target = batch
         # if record_stream() doesn't work, another option is to make sure device inputs are created
         # on the main stream.
         # self.next_input_gpu = torch.empty_like(self.next_input, device='cuda')
@@ -22,8 +73,10 @@ class data_prefetcher():
         # at the time we start copying to next_*:
         # self.stream.wait_stream(torch.cuda.current_stream())
         with torch.cuda.stream(self.stream):
-            self.next_input = self.next_input.cuda(device=self.device, non_blocking=True)
+            self.next_input = self.next_input.cuda(device=self.device, non_blocking=True, memory_format=self.memory_format)
             self.next_target = self.next_target.cuda(device=self.device, non_blocking=True)
+            if self.pin_pool is not None:
+                self.pin_pool.record(self.stream)
             # more code for the alternative if record_stream() doesn't work:
             # copy_ will record the use of the pinned source tensor in this side stream.
             # self.next_input_gpu.copy_(self.next_input, non_blocking=True)
@@ -36,6 +89,10 @@ class data_prefetcher():
             #     self.next_input = self.next_input.half()
             # else:
 
+        if self.pin_pool is not None:
+            # stage batch N+2 while batch N+1 is copied and batch N computes
+            self.next_pinned = self.pin_pool.submit(self.loader)
+
     def next(self):
         torch.cuda.current_stream().wait_stream(self.stream)
         input = self.next_input
@@ -45,4 +102,13 @@ class data_prefetcher():
         if target is not None:
             target.record_stream(torch.cuda.current_stream())
         self.preload()
-        return input, target
\ No newline at end of file
+        return input, target
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        input, target = self.next()
+        if input is None:
+            raise StopIteration
+        return input, target